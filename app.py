@@ -1,95 +1,310 @@
 import os
+import time
+import uuid
+import inspect
+import struct
+import asyncio
 import datetime
+import threading
+from collections import OrderedDict, deque
+from itertools import chain, islice
+from concurrent.futures import ThreadPoolExecutor
 from io import BytesIO
+from urllib.parse import quote
 import streamlit as st
-from PIL import Image
-import vertexai
-from vertexai.preview.vision_models import ImageGenerationModel
-from vertexai.generative_models import GenerativeModel, Part
-from google.oauth2 import service_account
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+from PIL import Image, ImageOps
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_exponential
 
 # ---------------- CONFIG ----------------
-PROJECT_ID = st.secrets["gcp_service_account"]["project_id"]
-credentials = service_account.Credentials.from_service_account_info(
-    dict(st.secrets["gcp_service_account"])
+# Credentials, vertexai.init and model handles are built once per process
+# and shared across reruns/sessions via st.cache_resource. The Google auth and
+# Vertex SDKs are imported inside them so sessions that never call a model
+# skip their cold import.
+# Set VERTEX_LOCATION to the region the app is deployed in (one that serves
+# Imagen and Gemini) to avoid a cross-region round-trip on every call.
+VERTEX_LOCATION = os.environ.get("VERTEX_LOCATION", "us-central1")
+
+@st.cache_resource(show_spinner=False)
+def get_credentials():
+    from google.oauth2 import service_account
+
+    # The secrets section is already a mapping; no need to copy it into a dict
+    return service_account.Credentials.from_service_account_info(
+        st.secrets["gcp_service_account"]
+    )
+
+@st.cache_resource(show_spinner=False)
+def init_vertex():
+    """Run vertexai.init exactly once per process (survives hot reloads)."""
+    import vertexai
+
+    credentials = get_credentials()
+    vertexai.init(
+        project=st.secrets["gcp_service_account"]["project_id"],
+        location=VERTEX_LOCATION,
+        credentials=credentials,
+    )
+    return credentials
+
+# Models
+@st.cache_resource(show_spinner=False)
+def get_imagen_model():
+    from vertexai.preview.vision_models import ImageGenerationModel
+
+    init_vertex()
+    return ImageGenerationModel.from_pretrained("imagen-4.0-generate-001")
+
+# Standing rules for the editor live in its system instruction so each edit
+# request only carries the short per-edit prompt below.
+EDIT_SYSTEM_INSTRUCTION = """You are a professional AI image editor.
+
+Instructions:
+- Take the provided image.
+- Apply the requested edits.
+- Return the final edited image inline (PNG).
+- Do not include any extra text or captions unless mentioned.
+"""
+_EDIT_TMPL = "Edit this image: {edit_prompt}. Return only the edited image inline."
+
+@st.cache_resource(show_spinner=False)
+def get_nano_banana():
+    from vertexai.generative_models import GenerativeModel
+
+    init_vertex()
+    return GenerativeModel("gemini-2.5-flash-image", system_instruction=EDIT_SYSTEM_INSTRUCTION)  # Editor
+
+@st.cache_resource(show_spinner=False)
+def get_text_model():
+    from vertexai.generative_models import GenerativeModel
+
+    init_vertex()
+    return GenerativeModel("gemini-2.0-flash")  # Prompt refiner
+
+# ---------------- RETRIES ----------------
+# Transient quota/availability errors are retried with exponential backoff
+# rather than surfaced straight away (a manual re-click also re-runs refinement).
+def _is_transient(exc):
+    from google.api_core.exceptions import DeadlineExceeded, ResourceExhausted, ServiceUnavailable
+
+    return isinstance(exc, (ResourceExhausted, ServiceUnavailable, DeadlineExceeded))
+
+vertex_retry = retry(
+    stop=stop_after_attempt(3),
+    wait=wait_exponential(min=1, max=10),
+    retry=retry_if_exception(_is_transient),
+    reraise=True,
 )
 
-# Init VertexAI
-vertexai.init(project=PROJECT_ID, location="us-central1", credentials=credentials)
+@vertex_retry
+def generate_images(prompt, number_of_images=1):
+    return get_imagen_model().generate_images(prompt=prompt, number_of_images=number_of_images)
 
-# Models
-IMAGEN_MODEL = ImageGenerationModel.from_pretrained("imagen-4.0-generate-001")
-NANO_BANANA = GenerativeModel("gemini-2.5-flash-image")  # Editor
-TEXT_MODEL = GenerativeModel("gemini-2.0-flash")  # Prompt refiner
+@vertex_retry
+def request_edit(contents):
+    # Always called from a worker thread (see run_edits_concurrently), so the
+    # blocking call doesn't hold up the script thread.
+    return get_nano_banana().generate_content(contents)
+
+@vertex_retry
+def start_refinement_stream(refinement_prompt):
+    """Open a streamed refinement and pull its first chunk, so request errors
+    surface (and are retried) before anything has been shown."""
+    stream = iter(get_text_model().generate_content(refinement_prompt, stream=True))
+    return next(stream, None), stream
 
 # ---------------- STREAMLIT CONFIG ----------------
 st.set_page_config(page_title="AI Image Generator + Editor", layout="wide")
 st.title("AI Image Generator + Editor")
 
 # ---------------- STATE ----------------
+# History keeps only file paths (bytes live on disk next to the app), capped
+# so long sessions don't grow without bound.
+HISTORY_LIMIT = 50
 if "generated_images" not in st.session_state:
-    st.session_state.generated_images = []
+    st.session_state.generated_images = deque(maxlen=HISTORY_LIMIT)
 if "edited_images" not in st.session_state:
-    st.session_state.edited_images = []
+    st.session_state.edited_images = deque(maxlen=HISTORY_LIMIT)
 if "active_tab" not in st.session_state:
     st.session_state.active_tab = "generate"
 
 # ---------------- IMAGE DISPLAY WRAPPER ----------------
+# Newer Streamlit renamed use_column_width to use_container_width; pick the
+# supported one once instead of catching a TypeError on every image.
+_FULL_WIDTH_KWARG = (
+    "use_container_width"
+    if "use_container_width" in inspect.signature(st.image).parameters
+    else "use_column_width"
+)
+
 def show_image_safe(image_data, caption="Image"):
-    """Handles image rendering for all Streamlit versions."""
-    try:
-        st.image(image_data, caption=caption, use_container_width=True)
-    except TypeError:
-        st.image(image_data, caption=caption, use_column_width=True)
+    """Handles image rendering for all Streamlit versions.
+
+    Pass raw PNG/JPEG bytes where possible: st.image forwards them as-is
+    (media storage is keyed on content hash), whereas a PIL image gets
+    decoded and re-encoded on every rerun.
+    """
+    st.image(image_data, caption=caption, **{_FULL_WIDTH_KWARG: True})
 
 # ---------------- HELPERS ----------------
-def safe_get_enhanced_text(resp):
-    if hasattr(resp, "text") and resp.text:
-        return resp.text
-    if hasattr(resp, "candidates") and resp.candidates:
-        try:
-            return resp.candidates[0].content.parts[0].text
-        except Exception:
-            pass
-    return str(resp)
+@st.cache_resource(show_spinner=False)
+def _get_io_pool():
+    """Background writer pool plus the writes it still has in flight."""
+    return ThreadPoolExecutor(max_workers=4), {}
+
+def _write_file(path, data):
+    with open(path, "wb") as f:
+        f.write(data)
+
+def save_image_async(path, data):
+    """Write image bytes off the script thread so rendering isn't blocked.
+
+    Only readers of the file (history previews) wait for the write; the
+    entry drops out of the registry as soon as it finishes.
+    """
+    pool, pending = _get_io_pool()
+    pending[path] = pool.submit(_write_file, path, data)
+    pending[path].add_done_callback(lambda _: pending.pop(path, None))
+
+@st.cache_data(ttl=3600, max_entries=32, show_spinner=False)
+def _read_image_file(path, mtime):
+    with open(path, "rb") as f:
+        return f.read()
+
+def wait_for_write(path):
+    """Block until any background write to path has finished."""
+    pending_write = _get_io_pool()[1].get(path)
+    if pending_write is not None:
+        pending_write.result()
+
+def _file_version(path):
+    """mtime of a saved image, once any background write to it has finished."""
+    wait_for_write(path)
+    return os.path.getmtime(path)
+
+def load_image_file(path):
+    """Read a saved image; cached on (path, mtime) so reruns don't hit disk."""
+    return _read_image_file(path, _file_version(path))
+
+@st.cache_data(max_entries=64, show_spinner=False)
+def _thumbnail(image_bytes: bytes, max_w: int = 512) -> bytes:
+    """Small JPEG preview for display; full-size bytes stay for edits and downloads."""
+    img = Image.open(BytesIO(image_bytes)).convert("RGB")
+    img.thumbnail((max_w, max_w), Image.LANCZOS)
+    buf = BytesIO()
+    # Encoded once per image (cached), so spend the extra pass on a smaller payload
+    img.save(buf, format="JPEG", quality=80, optimize=True)
+    return buf.getvalue()
+
+@st.cache_data(max_entries=128, show_spinner=False)
+def _thumbnail_file(path, mtime):
+    return _thumbnail(_read_image_file(path, mtime))
+
+def load_thumbnail(path):
+    """History preview for a saved image, keyed on (path, mtime) so reruns
+    neither read nor hash the full-size file."""
+    return _thumbnail_file(path, _file_version(path))
+
+@st.cache_data(max_entries=16, show_spinner=False)
+def _to_png(image_bytes: bytes) -> bytes:
+    """Re-encode an upload as RGB PNG; cached so reruns don't redo the decode.
+
+    These PNGs only travel to Nano Banana, so fast zlib (compress_level=1)
+    beats the default's slightly smaller output.
+    """
+    img = Image.open(BytesIO(image_bytes)).convert("RGB")
+    buf = BytesIO()
+    img.save(buf, format="PNG", compress_level=1)
+    return buf.getvalue()
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+def png_size(image_bytes):
+    """(width, height) read straight from a PNG's IHDR chunk."""
+    return struct.unpack(">II", image_bytes[16:24])
+
+EDIT_MAX_EDGE = 1536
+EDIT_PREVIEW_EDGE = 768
+# Images that have to be downscaled anyway are re-encoded as WebP q90 (much
+# smaller upload than PNG, keeps alpha); set to False to keep them lossless PNG.
+EDIT_DOWNSCALE_LOSSY = True
+# Upload formats Nano Banana accepts as-is, with the extension used when saving them
+EDIT_INPUT_EXTENSIONS = {"image/png": "png", "image/jpeg": "jpg", "image/webp": "webp"}
+
+@st.cache_data(max_entries=16, show_spinner=False)
+def _cap_resolution(image_bytes: bytes, mime_type: str, cap: int = EDIT_MAX_EDGE):
+    """Downscale images whose longest edge exceeds cap before sending them to Nano Banana.
+
+    Returns (bytes, mime_type); images already within the cap are returned untouched.
+    """
+    if image_bytes.startswith(PNG_SIGNATURE) and max(png_size(image_bytes)) <= cap:
+        return image_bytes, mime_type
+    img = Image.open(BytesIO(image_bytes))
+    if max(img.size) <= cap:
+        return image_bytes, mime_type
+    # Re-encoding drops the EXIF orientation tag, so bake the rotation in first
+    img = ImageOps.exif_transpose(img)
+    # Normalise odd modes (16-bit grey, CMYK, palette) that LANCZOS/PNG/WebP reject
+    has_alpha = img.mode in ("RGBA", "LA", "PA") or "transparency" in img.info
+    img = img.convert("RGBA" if has_alpha else "RGB")
+    img.thumbnail((cap, cap), Image.LANCZOS)
+    buf = BytesIO()
+    if EDIT_DOWNSCALE_LOSSY:
+        img.save(buf, format="WEBP", quality=90, method=4)
+        return buf.getvalue(), "image/webp"
+    img.save(buf, format="PNG", compress_level=1)
+    return buf.getvalue(), "image/png"
 
 def get_image_bytes_from_genobj(gen_obj):
     if isinstance(gen_obj, (bytes, bytearray)):
         return bytes(gen_obj)
-    for attr in ["image_bytes", "_image_bytes"]:
-        if hasattr(gen_obj, attr):
-            return getattr(gen_obj, attr)
-    if hasattr(gen_obj, "image") and gen_obj.image:
-        for attr in ["image_bytes", "_image_bytes"]:
-            if hasattr(gen_obj.image, attr):
-                return getattr(gen_obj.image, attr)
-    return None
+    data = getattr(gen_obj, "image_bytes", None) or getattr(gen_obj, "_image_bytes", None)
+    if data:
+        return data
+    image = getattr(gen_obj, "image", None)
+    if not image:
+        return None
+    return getattr(image, "image_bytes", None) or getattr(image, "_image_bytes", None)
 
 # ---------------- FIXED EDIT FUNCTION ----------------
-def run_edit_flow(edit_prompt, base_bytes):
-    """Edit image """
-    input_image = Part.from_data(mime_type="image/png", data=base_bytes)
+def iter_inline_data(response):
+    """Yield every inline data payload in a Gemini response."""
+    for candidate in getattr(response, "candidates", None) or ():
+        for part in getattr(getattr(candidate, "content", None), "parts", None) or ():
+            data = getattr(getattr(part, "inline_data", None), "data", None)
+            if data:
+                yield data
+
+def extract_inline_image(response):
+    """First inline image payload in a Gemini response, or None."""
+    return next(iter_inline_data(response), None)
+
+def _chunk_text(chunk):
+    """Text of a Gemini response or stream chunk, or "" when it has none."""
+    try:
+        return chunk.text or ""
+    except Exception:  # chunks without a text part raise on .text
+        return ""
 
-    edit_instruction = f"""
-You are a professional AI image editor.
+def make_image_part(base_bytes, mime_type="image/png"):
+    from vertexai.generative_models import Part
 
-Instructions:
-- Take the provided image.
-- Apply these edits: {edit_prompt}.
-- Return the final edited image inline (PNG).
-- Do not include any extra text or captions unless mentioned.
-"""
+    return Part.from_data(mime_type=mime_type, data=base_bytes)
+
+def edit_image_part(edit_prompt, input_image):
+    """Edit an image already wrapped in a Part (shareable across parallel edits)."""
+    edit_instruction = _EDIT_TMPL.format(edit_prompt=edit_prompt)
 
     try:
-        response = NANO_BANANA.generate_content([edit_instruction, input_image])
+        response = request_edit([edit_instruction, input_image])
 
-        for candidate in getattr(response, "candidates", []):
-            for part in getattr(candidate.content, "parts", []):
-                if hasattr(part, "inline_data") and getattr(part.inline_data, "data", None):
-                    return part.inline_data.data  # raw PNG bytes
+        image_bytes = extract_inline_image(response)
+        if image_bytes:
+            return image_bytes  # raw PNG bytes
 
-        if hasattr(response, "text") and response.text:
-            st.warning(f"⚠️ Gemini returned text instead of an image:\n\n{response.text}")
+        text = _chunk_text(response)
+        if text:
+            st.warning(f"⚠️ Gemini returned text instead of an image:\n\n{text}")
         else:
             st.error("⚠️ No inline image returned by Nano Banana.")
         return None
@@ -98,9 +313,77 @@ Instructions:
         st.error(f"❌ Error while editing: {e}")
         return None
 
+# ---------------- CONCURRENT REQUESTS ----------------
+# Vertex calls are blocking, so N images/edits are fanned out to threads and
+# awaited together; the semaphore keeps us clear of per-minute quota 429s.
+MAX_CONCURRENT_REQUESTS = 4
+
+def _with_script_ctx(fn):
+    """Let fn issue st.* calls (warnings/errors) from a worker thread."""
+    ctx = get_script_run_ctx()
+
+    def wrapper(*args, **kwargs):
+        add_script_run_ctx(threading.current_thread(), ctx)
+        return fn(*args, **kwargs)
+    return wrapper
+
+def _bounded_thread_calls(fn, calls):
+    sem = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+    fn = _with_script_ctx(fn)
+
+    async def run_one(args):
+        async with sem:
+            return await asyncio.to_thread(fn, *args)
+    return [run_one(args) for args in calls]
+
+async def _gather_in_threads(fn, calls):
+    return await asyncio.gather(*_bounded_thread_calls(fn, calls))
+
+async def _as_completed_in_threads(fn, calls):
+    for next_done in asyncio.as_completed(_bounded_thread_calls(fn, calls)):
+        yield await next_done
+
+def run_edits_concurrently(edit_prompt, base_bytes, n, mime_type="image/png"):
+    """Run n independent edits in parallel, dropping failed ones."""
+    input_image = make_image_part(base_bytes, mime_type)
+    results = asyncio.run(_gather_in_threads(edit_image_part, [(edit_prompt, input_image)] * n))
+    return [r for r in results if r]
+
+def generate_images_concurrently(prompt, n):
+    """All images from n parallel single-image Imagen requests."""
+    results = asyncio.run(_gather_in_threads(generate_images, [(prompt,)] * n))
+    return [img for resp in results for img in resp.images]
+
+@st.cache_resource(show_spinner=False)
+def _get_speculation_pool():
+    """Runs speculative Imagen batches alongside prompt refinement; kept apart
+    from the writer pool so a slow speculation never delays saves."""
+    return ThreadPoolExecutor(max_workers=MAX_CONCURRENT_REQUESTS)
+
+def iter_generated_images(prompt, n):
+    """Yield Imagen results one by one as their (parallel, single-image) requests finish.
+
+    Streamlit scripts are synchronous, so the async stream is stepped on a
+    private event loop; the worker threads keep running between yields.
+    """
+    stream = _as_completed_in_threads(generate_images, [(prompt,)] * n)
+    loop = asyncio.new_event_loop()
+    try:
+        while True:
+            try:
+                resp = loop.run_until_complete(anext(stream))
+            except StopAsyncIteration:
+                return
+            yield from resp.images
+    finally:
+        loop.run_until_complete(stream.aclose())
+        loop.close()
+
 # ---------------- DIRECT TRANSFER TO EDIT TAB ----------------
-def select_image_for_edit(img_bytes, filename):
-    st.session_state["edit_image_bytes"] = img_bytes
+def select_image_for_edit(path):
+    """Hand a saved image to the editor by path; its bytes are read on demand."""
+    filename = os.path.basename(path)
+    st.session_state["edit_image_path"] = path
     st.session_state["edit_image_name"] = filename
     st.session_state["active_tab"] = "edit"
     st.toast(f"✅ Image '{filename}' sent to Nano Banana editor.")
@@ -111,7 +394,7 @@ PROMPT_TEMPLATES = {
     "None": """
 Dont make any changes in the user's prompt.Follow it as it is
 User’s raw prompt:
-"{USER_PROMPT}"
+"{user_prompt}"
 
 Refined general image prompt:
 """,
@@ -133,7 +416,7 @@ Rules:
 - Output only the final refined image prompt.
 
 User’s raw prompt:
-"{USER_PROMPT}"
+"{user_prompt}"
 
 Refined general image prompt:
 """,
@@ -155,7 +438,7 @@ Rules:
 - Output only the final refined image prompt.
 
 User’s raw prompt:
-"{USER_PROMPT}"
+"{user_prompt}"
 
 Refined design image prompt:
 """,
@@ -182,7 +465,7 @@ Rules:
 - Output **only** the final refined image prompt (no explanations, no extra text).
 
 User raw input:
-{USER_PROMPT}
+{user_prompt}
 
 
 Refined marketing image prompt:
@@ -206,7 +489,7 @@ Rules:
 - Output only the final refined image prompt.
 
 User’s raw prompt:
-"{USER_PROMPT}"
+"{user_prompt}"
 
 Refined DPEX image prompt:
 """,
@@ -229,7 +512,7 @@ Rules:
 - Output only the final refined image prompt.
 
 User’s raw prompt:
-"{USER_PROMPT}"
+"{user_prompt}"
 
 Refined HR image prompt:
 """,
@@ -253,7 +536,7 @@ Rules:
 - Output only the final refined image prompt.
 
 User’s raw prompt:
-"{USER_PROMPT}"
+"{user_prompt}"
 
 Refined business image prompt:
 """
@@ -300,9 +583,112 @@ STYLE_DESCRIPTIONS = {
     "Vintage": "Old-school, retro tones. Faded colors, film grain, sepia, or retro print feel.",
     "Graffiti": "Urban street art style with bold colors, spray paint textures, and rebellious tone."
 }
+# ---------------- PROMPT REFINEMENT ----------------
+# Each template is split once around its single {user_prompt} marker, so
+# building a prompt is a join rather than a scan; style suffixes are built
+# once too ("None" adds nothing).
+def _split_template(dept, template):
+    parts = template.split("{user_prompt}")
+    assert len(parts) == 2, f"{dept} template must contain exactly one {{user_prompt}}"
+    return parts
+
+_TEMPLATE_PARTS = {k: _split_template(k, v) for k, v in PROMPT_TEMPLATES.items()}
+_STYLE_SUFFIXES = {
+    k: "" if k == "None" else f"\n\nApply style: {v}"
+    for k, v in STYLE_DESCRIPTIONS.items()
+}
+
+def build_refinement_prompt(dept: str, style: str, user_prompt: str) -> str:
+    return user_prompt.join(_TEMPLATE_PARTS[dept]) + _STYLE_SUFFIXES[style]
+
+def same_prompt(refined, raw):
+    """True when refinement left the prompt as-is (ignoring whitespace/quotes)."""
+    return refined.strip().strip('"').strip() == raw.strip()
+
+# Refined prompts are streamed to the page as Gemini writes them, which
+# st.cache_data can't wrap (a cached function may not write to an outside
+# placeholder), so repeats are served from this small process-wide TTL/LRU
+# cache instead.
+REFINE_CACHE_TTL = 24 * 60 * 60
+REFINE_CACHE_MAX_ENTRIES = 256
+
+@st.cache_resource(show_spinner=False)
+def _refined_prompt_cache():
+    """{(dept, style, user_prompt): (expires_at, text)} shared by all sessions."""
+    return OrderedDict(), threading.Lock()
+
+def _cached_refinement(key):
+    cache, lock = _refined_prompt_cache()
+    with lock:
+        hit = cache.get(key)
+        if hit is None:
+            return None
+        if hit[0] < time.monotonic():
+            del cache[key]
+            return None
+        cache.move_to_end(key)
+        return hit[1]
+
+def _store_refinement(key, text):
+    cache, lock = _refined_prompt_cache()
+    with lock:
+        cache[key] = (time.monotonic() + REFINE_CACHE_TTL, text)
+        cache.move_to_end(key)
+        while len(cache) > REFINE_CACHE_MAX_ENTRIES:
+            cache.popitem(last=False)
+
+def refinement_key(dept: str, style: str, user_prompt: str):
+    """Refinement cache key; ignores surrounding whitespace only (case matters,
+    since the "None" department passes the prompt through and Imagen renders
+    any quoted text as written)."""
+    return (dept, style, user_prompt.strip())
+
+def stream_refined_prompt(dept: str, style: str, user_prompt: str):
+    """Yield the refined prompt as Gemini streams it; repeated inputs come from cache."""
+    key = refinement_key(dept, style, user_prompt)
+    cached = _cached_refinement(key)
+    if cached is not None:
+        yield cached
+        return
+    refinement_prompt = build_refinement_prompt(dept, style, user_prompt)
+    first_chunk, rest = start_refinement_stream(refinement_prompt)
+    chunks = []
+    for chunk in chain([first_chunk] if first_chunk is not None else [], rest):
+        text = _chunk_text(chunk)
+        chunks.append(text)
+        yield text
+    refined = "".join(chunks).strip()
+    if refined:  # a blocked/empty stream must not be cached for the TTL
+        _store_refinement(key, refined)
+
 # ---------------- CREATE OUTPUT FOLDERS ----------------
-os.makedirs("outputs/generated", exist_ok=True)
-os.makedirs("outputs/edited", exist_ok=True)
+# Model outputs live under static/ next to this script so Streamlit's static
+# file server (.streamlit/config.toml) can serve downloads straight from disk.
+# That server is public and unauthenticated, so saved names carry a uuid and
+# raw user uploads are kept outside static/.
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+STATIC_DIR = os.path.join(APP_DIR, "static")
+GENERATED_DIR = os.path.join(STATIC_DIR, "outputs", "generated")
+EDITED_DIR = os.path.join(STATIC_DIR, "outputs", "edited")
+UPLOADS_DIR = os.path.join(APP_DIR, "outputs", "uploads")
+
+@st.cache_resource(show_spinner=False)
+def _ensure_dirs():
+    os.makedirs(GENERATED_DIR, exist_ok=True)
+    os.makedirs(EDITED_DIR, exist_ok=True)
+    os.makedirs(UPLOADS_DIR, exist_ok=True)
+    return True
+
+def download_link(path, label):
+    """Render a download link served by the static file server instead of
+    pushing the file's bytes through st.download_button.
+
+    The link is only a URL, so it doesn't wait for a background write of path.
+    """
+    url = "app/static/" + quote(os.path.relpath(path, STATIC_DIR).replace(os.sep, "/"))
+    st.markdown(f'<a href="{url}" download="{os.path.basename(path)}">{label}</a>', unsafe_allow_html=True)
+
+_ensure_dirs()
 
 # ---------------- TABS ----------------
 tab_generate, tab_edit = st.tabs([" Generate Images", "Edit Images"])
@@ -311,137 +697,174 @@ tab_generate, tab_edit = st.tabs([" Generate Images", "Edit Images"])
 with tab_generate:
     st.header(" Generate Images ")
 
-    dept = st.selectbox("🏢 Department", list(PROMPT_TEMPLATES.keys()), index=0)
-    style = st.selectbox("🎨 Style", list(STYLE_DESCRIPTIONS.keys()), index=0)
-    user_prompt = st.text_area("Enter your prompt", height=120)
-    num_images = 1
+    # Inputs sit in a form so editing them doesn't rerun the script until submit
+    with st.form("generate_form"):
+        dept = st.selectbox("🏢 Department", list(PROMPT_TEMPLATES.keys()), index=0)
+        style = st.selectbox("🎨 Style", list(STYLE_DESCRIPTIONS.keys()), index=0)
+        user_prompt = st.text_area("Enter your prompt", height=120)
+        num_images = 1
+        generate_clicked = st.form_submit_button(" Generate Images")
 
-    if st.button(" Generate Images"):
+    if generate_clicked:
         if not user_prompt.strip():
             st.warning("Please enter a prompt.")
         else:
+            # With no department/style the refiner is told to leave the prompt
+            # alone, so on a refinement cache miss start Imagen on the raw prompt
+            # in parallel and keep the result only if the refined prompt comes
+            # back unchanged. A cache hit already has its prompt, so it skips
+            # the speculation. cancel() can't stop a request already in flight,
+            # so a discarded speculative image is still billed.
+            speculative = None
+            if (dept == "None" and style == "None"
+                    and _cached_refinement(refinement_key(dept, style, user_prompt)) is None):
+                # Wrapped so cached model handles (and st.* calls) work off-thread
+                speculative = _get_speculation_pool().submit(
+                    _with_script_ctx(generate_images_concurrently), user_prompt, num_images
+                )
             with st.spinner("Refining prompt with Gemini..."):
-                refinement_prompt = PROMPT_TEMPLATES[dept].replace("{USER_PROMPT}", user_prompt)
-                if style != "None":
-                    refinement_prompt += f"\n\nApply style: {STYLE_DESCRIPTIONS[style]}"
-                text_resp = TEXT_MODEL.generate_content(refinement_prompt)
-                enhanced_prompt = safe_get_enhanced_text(text_resp).strip()
-                st.info(f"🔮 Enhanced Prompt:\n\n{enhanced_prompt}")
+                with st.container(border=True):
+                    st.markdown("🔮 **Enhanced Prompt:**")
+                    streamed = st.write_stream(stream_refined_prompt(dept, style, user_prompt))
+                enhanced_prompt = (streamed or "").strip()
+            if not enhanced_prompt:
+                st.warning("⚠️ Gemini returned no refined prompt; using your prompt as-is.")
+                enhanced_prompt = user_prompt.strip()
+            if speculative is not None and not same_prompt(enhanced_prompt, user_prompt):
+                speculative.cancel()
+                speculative = None
 
             with st.spinner("Generating images with Imagen 4..."):
                 try:
-                    resp = IMAGEN_MODEL.generate_images(prompt=enhanced_prompt, number_of_images=num_images)
+                    # One placeholder per image, filled as each request completes
+                    slots = [st.empty() for _ in range(num_images)]
+                    ts = datetime.datetime.now().strftime('%Y%m%d_%H%M%S')
+                    # History holds only paths, so names must be unique across sessions
+                    run_id = uuid.uuid4().hex
+                    if speculative is not None:
+                        gen_stream = speculative.result()
+                    else:
+                        gen_stream = iter_generated_images(enhanced_prompt, num_images)
+                    shown = 0
+                    for i, gen_obj in enumerate(gen_stream):
+                        with slots[i].container():
+                            try:
+                                img_bytes = get_image_bytes_from_genobj(gen_obj)
+                                if not img_bytes:
+                                    continue
+                                filename = f"{GENERATED_DIR}/{dept.lower()}_{style.lower()}_{ts}_{run_id}_{i}.png"
+                                save_image_async(filename, img_bytes)
+                                st.session_state.generated_images.append({"filename": filename})
+
+                                show_image_safe(img_bytes, caption=os.path.basename(filename))
+                                shown += 1
+
+                                col_a, col_b = st.columns(2)
+                                with col_a:
+                                    download_link(filename, "⬇️ Download")
+
+                            except Exception as e:
+                                st.error(f"⚠️ Failed to display image {i}: {e}")
+                    if not shown:
+                        st.warning("⚠️ Imagen returned no images (the prompt may have been filtered).")
                 except Exception as e:
                     st.error(f"⚠️ Imagen error: {e}")
                     st.stop()
 
-                for i in range(num_images):
-                    try:
-                        gen_obj = resp.images[i]
-                        img_bytes = get_image_bytes_from_genobj(gen_obj)
-                        if not img_bytes:
-                            continue
-                        filename = f"outputs/generated/{dept.lower()}_{style.lower()}_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}_{i}.png"
-                        with open(filename, "wb") as f:
-                            f.write(img_bytes)
-                        st.session_state.generated_images.append({"filename": filename, "content": img_bytes})
-
-                        show_image_safe(Image.open(BytesIO(img_bytes)), caption=os.path.basename(filename))
-
-                        col_a, col_b = st.columns(2)
-                        with col_a:
-                            st.download_button("⬇️ Download", data=img_bytes, file_name=os.path.basename(filename), mime="image/png", key=f"dl_gen_{i}")
-                        
-                    except Exception as e:
-                        st.error(f"⚠️ Failed to display image {i}: {e}")
-
 # ---------------- EDIT TAB ----------------
-with tab_edit:
+# st.fragment is GA from Streamlit 1.37; 1.36 (pinned) ships it as experimental
+_fragment = getattr(st, "fragment", None) or st.experimental_fragment
+
+@_fragment
+def editor_panel():
+    """Edit tab body; interacting with it reruns only this fragment.
+
+    New edits land in the History section on the next full rerun.
+    """
     st.header("Edit Images")
 
     uploaded_file = st.file_uploader("📤 Upload an image", type=["png", "jpg", "jpeg", "webp"])
     base_image = None
+    base_mime = "image/png"
 
-    if "edit_image_bytes" in st.session_state:
-        base_image = st.session_state["edit_image_bytes"]
-        show_image_safe(Image.open(BytesIO(base_image)),
+    if "edit_image_path" in st.session_state:
+        base_image = load_image_file(st.session_state["edit_image_path"])
+        show_image_safe(_thumbnail(base_image, EDIT_PREVIEW_EDGE),
                         caption=f"Editing: {st.session_state.get('edit_image_name','Selected Image')}")
     elif uploaded_file:
-        image_bytes = uploaded_file.read()
-        img = Image.open(BytesIO(image_bytes)).convert("RGB")
-        buf = BytesIO()
-        img.save(buf, format="PNG")
-        base_image = buf.getvalue()
-        show_image_safe(base_image, caption="Uploaded Image")
+        image_bytes = uploaded_file.getvalue()
+        if uploaded_file.type in EDIT_INPUT_EXTENSIONS:
+            # Nano Banana takes PNG/JPEG/WebP as-is; skip the decode + PNG re-encode
+            base_image = image_bytes
+            base_mime = uploaded_file.type
+        else:
+            base_image = _to_png(image_bytes)
+        base_image, base_mime = _cap_resolution(base_image, base_mime)
+        show_image_safe(_thumbnail(base_image, EDIT_PREVIEW_EDGE), caption="Uploaded Image")
 
-    edit_prompt = st.text_area("Enter your edit instruction", height=120)
-    num_edits = 1
+    with st.form("edit_form"):
+        edit_prompt = st.text_area("Enter your edit instruction", height=120)
+        num_edits = 1
+        edit_clicked = st.form_submit_button(" Edit image")
 
-    if st.button(" Edit image"):
+    if edit_clicked:
         if not base_image or not edit_prompt.strip():
             st.warning("Please upload an image and enter instructions.")
         else:
             with st.spinner("Editing with Nano Banana..."):
-                edited_versions = []
-                for _ in range(num_edits):
-                    edited = run_edit_flow(edit_prompt, base_image)
-                    if edited:
-                        edited_versions.append(edited)
+                edited_versions = run_edits_concurrently(edit_prompt, base_image, num_edits, base_mime)
 
                 if edited_versions:
+                    ts = datetime.datetime.now().strftime('%Y%m%d_%H%M%S')
+                    run_id = uuid.uuid4().hex
+                    original_path = f"{UPLOADS_DIR}/original_{ts}_{run_id}.{EDIT_INPUT_EXTENSIONS[base_mime]}"
+                    save_image_async(original_path, base_image)
+
                     for i, out_bytes in enumerate(edited_versions):
-                        filename = f"outputs/edited/edited_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}_{i}.png"
-                        with open(filename, "wb") as f:
-                            f.write(out_bytes)
-
-                        show_image_safe(Image.open(BytesIO(out_bytes)), caption=f"Edited Version {i+1}")
-                        st.download_button(
-                            f"⬇️ Download Edited {i+1}",
-                            data=out_bytes,
-                            file_name=os.path.basename(filename),
-                            mime="image/png",
-                            key=f"edit_dl_{i}_{datetime.datetime.now().timestamp()}"
-                        )
+                        filename = f"{EDITED_DIR}/edited_{ts}_{run_id}_{i}.png"
+                        save_image_async(filename, out_bytes)
+
+                        show_image_safe(out_bytes, caption=f"Edited Version {i+1}")
+                        download_link(filename, f"⬇️ Download Edited {i+1}")
                         st.session_state.edited_images.append({
-                            "original": base_image,
-                            "edited": out_bytes,
+                            "original_path": original_path,
+                            "edited_path": filename,
                             "prompt": edit_prompt
                         })
                 else:
                     st.error("❌ No edited image returned by Nano Banana.")
 
+with tab_edit:
+    editor_panel()
+
 # ---------------- HISTORY ----------------
 st.subheader("📂 History")
 
+def show_saved_thumbnail(path, caption):
+    """Preview a saved image; shows a placeholder and returns False if the
+    file failed to write or has since been cleaned up."""
+    try:
+        thumb = load_thumbnail(path)
+    except OSError:
+        st.caption(f"⚠️ {caption}: image file is no longer available.")
+        return False
+    show_image_safe(thumb, caption=caption)
+    return True
+
 if st.session_state.generated_images:
     st.markdown("### Generated Images")
-    for i, img in enumerate(reversed(st.session_state.generated_images[-10:])):
+    for i, img in enumerate(islice(reversed(st.session_state.generated_images), 10)):
         with st.expander(f"{i+1}. {os.path.basename(img.get('filename', 'Unnamed Image'))}"):
-            content = img.get("content")
-            show_image_safe(Image.open(BytesIO(content)), caption=os.path.basename(img.get("filename", "")))
-            st.download_button(
-                "⬇️ Download Again",
-                data=content,
-                file_name=os.path.basename(img.get("filename", "generated_image.png")),
-                mime="image/png",
-                key=f"gen_dl_hist_{i}_{datetime.datetime.now().timestamp()}"
-            )
+            if show_saved_thumbnail(img["filename"], os.path.basename(img["filename"])):
+                download_link(img["filename"], "⬇️ Download Again")
 
 if st.session_state.edited_images:
     st.markdown("### Edited Images")
-    for i, entry in enumerate(reversed(st.session_state.edited_images[-10:])):
+    for i, entry in enumerate(islice(reversed(st.session_state.edited_images), 10)):
         with st.expander(f"Edited {i+1}: {entry.get('prompt', '')}"):
             col1, col2 = st.columns(2)
             with col1:
-                orig_bytes = entry.get("original")
-                show_image_safe(Image.open(BytesIO(orig_bytes)), caption="Original")
+                show_saved_thumbnail(entry["original_path"], "Original")
             with col2:
-                edited_bytes = entry.get("edited")
-                show_image_safe(Image.open(BytesIO(edited_bytes)), caption="Edited")
-                st.download_button(
-                    "⬇️ Download Edited",
-                    data=edited_bytes,
-                    file_name=f"edited_{i}.png",
-                    mime="image/png",
-                    key=f"edit_dl_hist_{i}_{datetime.datetime.now().timestamp()}"
-                )
+                if show_saved_thumbnail(entry["edited_path"], "Edited"):
+                    download_link(entry["edited_path"], "⬇️ Download Edited")